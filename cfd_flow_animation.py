@@ -4,146 +4,390 @@ Streamlined CFD animation generator for OpenFOAM motorbike simulation.
 Creates a 2x2 grid showing velocity, pressure, geometry, and flow analysis.
 """
 
+import contextlib
+import logging
+import multiprocessing as mp
 import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import imageio_ffmpeg
 import pyvista as pv
 import numpy as np
+import vtk
 
-def load_data():
-    """Load volume data and motorbike parts"""
+from motorbike_parts import PART_REDUCTION, load_parts
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+STRUCTURED_TYPES = (vtk.vtkStructuredGrid, vtk.vtkRectilinearGrid, vtk.vtkImageData)
+VIEW_SIZE = (960, 540)
+QUANTIZED_FIELDS = ("U", "p", "omega", "k")
+# Below this many points the Numba kernels cost more in JIT/cache loading than they save
+NUMBA_MIN_POINTS = 1_000_000
+# fastmath without ninf/nnan, which would make the min/max reductions undefined
+NUMBA_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+logger = logging.getLogger(__name__)
+worker_state = {}
+
+# Prefer a GPU-backed EGL context over software X/OSMesa fallbacks on headless machines
+if "DISPLAY" not in os.environ:
+    os.environ.setdefault("VTK_DEFAULT_OPENGL_WINDOW", "vtkEGLRenderWindow")
+
+def load_data(downsample=2):
+    """Load the full and decimated motorbike surfaces and feature edges, and precompute slices and streamlines.
+    
+    Structured volumes are subsampled by ``downsample`` along each axis before slicing,
+    which is visually lossless at the subplot resolution; unstructured volumes are used as is.
+    """
     volume_file = os.path.join("motorBike-VTK", "motorBike_500.vtk")
-    volume_mesh = pv.read(volume_file)
-    
-    bike_parts = []
-    for root, dirs, files in os.walk("motorBike-VTK"):
-        for fname in files:
-            if fname.endswith("_500.vtk") and fname != "motorBike_500.vtk":
-                part_path = os.path.join(root, fname)
-                try:
-                    bike_parts.append(pv.read(part_path))
-                except:
-                    continue
-    
-    return volume_mesh, pv.MultiBlock(bike_parts).combine()
-
-def setup_velocity_view(plotter, volume_mesh, bike_surface, angle):
-    """Setup velocity field visualization"""
-    plotter.subplot(0, 0)
-    plotter.add_text("Velocity Field (m/s)", position='upper_left', font_size=12, color='black')
+    volume_mesh = downsample_volume(pv.read(volume_file), downsample)
+    center = tuple(volume_mesh.center)
+    has_omega = "omega" in volume_mesh.array_names
+    has_k = "k" in volume_mesh.array_names
+    
+    slices = build_slices(volume_mesh, center)
+    streamlines = build_streamlines(volume_mesh, center)
+    
+    # The geometry panel shows every mesh edge, so only the field panels get the decimated surface
+    bike_surface = load_bike_surface()
+    bike_background = load_bike_surface(PART_REDUCTION)
+    bike_edges = bike_surface.extract_feature_edges(feature_angle=30, boundary_edges=True,
+                                                    non_manifold_edges=False, manifold_edges=False)
+    
+    return bike_surface, bike_background, bike_edges, slices, streamlines, has_omega, has_k
+
+def load_bike_surface(reduction=0.0):
+    """Combine the (cached) motorbike parts, decimated by reduction, into a single PolyData surface"""
+    appender = vtk.vtkAppendPolyData()
+    for part in load_parts(reduction):
+        # Raw parts are returned as read, so skin any that are not already surfaces
+        appender.AddInputData(part if isinstance(part, pv.PolyData) else part.extract_surface())
+    appender.Update()
+    
+    return pv.wrap(appender.GetOutput()).clean()
+
+def downsample_volume(mesh, rate):
+    """Keep every rate-th point along each axis of a structured volume"""
+    if rate <= 1 or not isinstance(mesh, STRUCTURED_TYPES):
+        return mesh
+    
+    extent = list(mesh.GetExtent())
+    if isinstance(mesh, vtk.vtkImageData):
+        # Image data has uniform spacing, so an extra boundary sample would stretch the volume;
+        # clamp each axis to the last point on the rate grid instead
+        extractor = vtk.vtkExtractVOI()
+        for axis in range(3):
+            lo, hi = extent[2 * axis], extent[2 * axis + 1]
+            extent[2 * axis + 1] = lo + (hi - lo) // rate * rate
+    else:
+        extractor = vtk.vtkExtractRectilinearGrid() if isinstance(mesh, vtk.vtkRectilinearGrid) else vtk.vtkExtractGrid()
+        extractor.IncludeBoundaryOn()
+    extractor.SetVOI(extent)
+    extractor.SetSampleRate(rate, rate, rate)
+    extractor.SetInputData(mesh)
+    extractor.Update()
+    return pv.wrap(extractor.GetOutput())
+
+def fast_slice(mesh, origin, normal):
+    """Slice with vtkStructuredDataPlaneCutter for structured grids, falls back to mesh.slice otherwise"""
+    if not isinstance(mesh, STRUCTURED_TYPES):
+        return mesh.slice(origin=origin, normal=normal)
+    
+    plane = vtk.vtkPlane()
+    plane.SetOrigin(origin)
+    plane.SetNormal(normal)
+    cutter = vtk.vtkStructuredDataPlaneCutter()
+    cutter.SetPlane(plane)
+    cutter.GeneratePolygonsOff()
+    cutter.SetInputData(mesh)
+    cutter.Update()
+    return pv.wrap(cutter.GetOutput())
+
+def build_slices(volume_mesh, center):
+    """Cut all slice planes once; the planes are fixed, only the camera moves"""
+    slices = {
+        "long": fast_slice(volume_mesh, center, [0, 1, 0]),
+        "wake": fast_slice(volume_mesh, [center[0]+1.0, center[1], center[2]], [1, 0, 0]),
+        "ground": fast_slice(volume_mesh, [center[0], center[1], 0.8], [0, 0, 1]),
+        "p_back": fast_slice(volume_mesh, [center[0] + 0.5, center[1], center[2]], [1, 0, 0]),
+        "p_front": fast_slice(volume_mesh, [center[0] - 0.5, center[1], center[2]], [1, 0, 0]),
+        "wake_far": fast_slice(volume_mesh, [center[0]+2.0, center[1], center[2]], [1, 0, 0]),
+    }
+    
+    for slice_mesh in slices.values():
+        for name in QUANTIZED_FIELDS:
+            if name in slice_mesh.point_data:
+                slice_mesh.point_data[f"{name}_q"] = quantize_scalars(slice_mesh.point_data[name])
+    return slices
+
+def quantize_scalars(values):
+    """Map a scalar field (or vector magnitude) onto 0-255 lookup table indices"""
+    values = np.asarray(values, dtype=np.float32)
+    if values.shape[0] == 0:
+        return np.zeros(0, dtype=np.uint8)
+    if njit is not None and values.shape[0] >= NUMBA_MIN_POINTS:
+        out = np.empty(values.shape[0], dtype=np.uint8)
+        if values.ndim > 1:
+            quantize_magnitude(np.ascontiguousarray(values), out)
+        else:
+            quantize_values(values, out)
+        return out
+    
+    if values.ndim > 1:
+        values = np.linalg.norm(values, axis=1)
+    lo, hi = values.min(), values.max()
+    if hi <= lo:
+        return np.zeros(values.shape, dtype=np.uint8)
+    return np.clip((values - lo) * (255.0 / (hi - lo)), 0, 255).astype(np.uint8)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=NUMBA_FASTMATH, cache=True)
+    def quantize_magnitude(vectors, out):
+        """Fused magnitude, normalise, clip and cast of a non-empty (N, 3) array into out"""
+        n = vectors.shape[0]
+        lo = hi = (vectors[0, 0]**2 + vectors[0, 1]**2 + vectors[0, 2]**2) ** 0.5
+        for i in prange(1, n):
+            m = (vectors[i, 0]**2 + vectors[i, 1]**2 + vectors[i, 2]**2) ** 0.5
+            lo = min(lo, m)
+            hi = max(hi, m)
+        scale = 255.0 / (hi - lo) if hi > lo else 0.0
+        for i in prange(n):
+            m = (vectors[i, 0]**2 + vectors[i, 1]**2 + vectors[i, 2]**2) ** 0.5
+            v = (m - lo) * scale
+            if v < 0.0:
+                v = 0.0
+            elif v > 255.0:
+                v = 255.0
+            out[i] = np.uint8(v)
+    
+    @njit(parallel=True, fastmath=NUMBA_FASTMATH, cache=True)
+    def quantize_values(values, out):
+        """Fused normalise, clip and cast of a non-empty (N,) array into out"""
+        n = values.shape[0]
+        lo = hi = values[0]
+        for i in prange(1, n):
+            lo = min(lo, values[i])
+            hi = max(hi, values[i])
+        scale = 255.0 / (hi - lo) if hi > lo else 0.0
+        for i in prange(n):
+            v = (values[i] - lo) * scale
+            if v < 0.0:
+                v = 0.0
+            elif v > 255.0:
+                v = 255.0
+            out[i] = np.uint8(v)
+
+def build_streamlines(volume_mesh, center):
+    """Integrate streamlines once, returns None if integration fails or traces nothing"""
+    Y, Z = np.meshgrid([-1.0, 0.0, 1.0], [1.5, 2.0, 2.5], indexing="ij")
+    seed_points = np.column_stack([np.full(Y.size, center[0]-3), Y.ravel(), Z.ravel()])
+    try:
+        seed_poly = pv.PolyData(seed_points)
+        streamlines = volume_mesh.streamlines_from_source(seed_poly, vectors="U", max_steps=100, integration_direction='forward')
+    except (RuntimeError, ValueError) as e:
+        logger.warning("skip streamlines: %s", e)
+        return None
     
-    center = volume_mesh.center
-    slice_long = volume_mesh.slice(origin=center, normal=[0, 1, 0])
-    slice_wake = volume_mesh.slice(origin=[center[0]+1.0, center[1], center[2]], normal=[1, 0, 0])
-    slice_ground = volume_mesh.slice(origin=[center[0], center[1], 0.8], normal=[0, 0, 1])
+    # Seeds outside the flow give an empty trace, which add_mesh cannot plot
+    if streamlines.n_points == 0:
+        logger.warning("skip streamlines: no seed point reached the flow")
+        return None
+    return streamlines
+
+def build_velocity_view(plotter, slices, bike_surface, bike_edges):
+    """Add velocity field actors to the plotter"""
+    plotter.add_text("Velocity Field (m/s)", position='upper_left', font_size=12, color='black')
     
-    plotter.add_mesh(slice_long, scalars="U", cmap="jet", opacity=0.9, show_scalar_bar=False)
-    plotter.add_mesh(slice_wake, scalars="U", cmap="coolwarm", opacity=0.6, show_scalar_bar=False)
-    plotter.add_mesh(slice_ground, scalars="U", cmap="plasma", opacity=0.4, show_scalar_bar=False)
-    plotter.add_mesh(bike_surface, color="silver", opacity=0.7, show_edges=True, edge_color="black", line_width=0.2)
+    plotter.add_mesh(slices["long"], scalars="U_q", clim=[0, 255], cmap="jet", opacity=0.9, show_scalar_bar=False)
+    plotter.add_mesh(slices["wake"], scalars="U_q", clim=[0, 255], cmap="coolwarm", opacity=0.6, show_scalar_bar=False)
+    plotter.add_mesh(slices["ground"], scalars="U_q", clim=[0, 255], cmap="plasma", opacity=0.4, show_scalar_bar=False)
+    plotter.add_mesh(bike_surface, color="silver", opacity=0.7)
+    plotter.add_mesh(bike_edges, color="black", line_width=0.2)
     plotter.add_scalar_bar(title="Velocity", position_x=0.85, width=0.05, height=0.3, title_font_size=8, label_font_size=7)
     
     plotter.set_background("white")
+
+def update_velocity_camera(plotter, angle):
+    """Move the velocity field camera to the current angle"""
     plotter.view_isometric()
     plotter.camera.azimuth = angle * 0.5
     plotter.camera.elevation = 20
     plotter.camera.zoom(1.2)
 
-def setup_pressure_view(plotter, volume_mesh, bike_surface, angle):
-    """Setup pressure field visualization"""
-    plotter.subplot(0, 1)
+def build_pressure_view(plotter, slices, bike_surface, bike_edges):
+    """Add pressure field actors to the plotter"""
     plotter.add_text("Pressure Field (Pa)", position='upper_left', font_size=12, color='black')
     
-    center = volume_mesh.center
-    slice_back = volume_mesh.slice(origin=[center[0] + 0.5, center[1], center[2]], normal=[1, 0, 0])
-    slice_front = volume_mesh.slice(origin=[center[0] - 0.5, center[1], center[2]], normal=[1, 0, 0])
-    
-    plotter.add_mesh(slice_back, scalars="p", cmap="coolwarm", opacity=0.9, show_scalar_bar=False)
-    plotter.add_mesh(slice_front, scalars="p", cmap="RdBu", opacity=0.6, show_scalar_bar=False)
-    plotter.add_mesh(bike_surface, color="darkgray", opacity=0.5, show_edges=True, edge_color="black", line_width=0.3)
+    plotter.add_mesh(slices["p_back"], scalars="p_q", clim=[0, 255], cmap="coolwarm", opacity=0.9, show_scalar_bar=False)
+    plotter.add_mesh(slices["p_front"], scalars="p_q", clim=[0, 255], cmap="RdBu", opacity=0.6, show_scalar_bar=False)
+    plotter.add_mesh(bike_surface, color="darkgray", opacity=0.5)
+    plotter.add_mesh(bike_edges, color="black", line_width=0.3)
     plotter.add_scalar_bar(title="Pressure", position_x=0.85, width=0.05, height=0.3, title_font_size=8, label_font_size=7)
     
     plotter.set_background("white")
+
+def update_pressure_camera(plotter, angle):
+    """Move the pressure field camera to the current angle"""
     plotter.view_isometric()
     plotter.camera.azimuth = angle * 0.5
     plotter.camera.elevation = 20
     plotter.camera.zoom(1.2)
 
-def setup_mesh_view(plotter, bike_surface, angle):
-    """Setup clean mesh visualization"""
-    plotter.subplot(1, 0)
+def build_mesh_view(plotter, bike_surface):
+    """Add clean mesh actors to the plotter"""
     plotter.add_text("Motorbike Geometry", position='upper_left', font_size=12, color='black')
     
     plotter.add_mesh(bike_surface, color="silver", opacity=0.9, show_edges=True, edge_color="black", line_width=0.4)
     
     plotter.set_background("white")
+
+def update_mesh_camera(plotter, angle):
+    """Move the mesh camera to the current angle"""
     plotter.view_isometric()
     plotter.camera.azimuth = angle
     plotter.camera.elevation = 25
     plotter.camera.zoom(1.3)
 
-def setup_flow_analysis(plotter, volume_mesh, bike_surface, angle):
-    """Setup flow analysis visualization"""
-    plotter.subplot(1, 1)
+def build_flow_analysis(plotter, slices, streamlines, bike_surface, bike_edges, has_omega, has_k):
+    """Add flow analysis actors to the plotter"""
     plotter.add_text("Flow Analysis & Wake", position='upper_left', font_size=12, color='black')
     
-    center = volume_mesh.center
-    wake_slice = volume_mesh.slice(origin=[center[0]+2.0, center[1], center[2]], normal=[1, 0, 0])
+    wake_slice = slices["wake_far"]
     
-    if "omega" in volume_mesh.array_names:
-        plotter.add_mesh(wake_slice, scalars="omega", cmap="turbo", opacity=0.8, show_scalar_bar=False)
+    if has_omega:
+        plotter.add_mesh(wake_slice, scalars="omega_q", clim=[0, 255], cmap="turbo", opacity=0.8, show_scalar_bar=False)
         field_name = "Turbulence"
-    elif "k" in volume_mesh.array_names:
-        plotter.add_mesh(wake_slice, scalars="k", cmap="hot", opacity=0.8, show_scalar_bar=False)
+    elif has_k:
+        plotter.add_mesh(wake_slice, scalars="k_q", clim=[0, 255], cmap="hot", opacity=0.8, show_scalar_bar=False)
         field_name = "Turbulent Energy"
     else:
-        plotter.add_mesh(wake_slice, scalars="U", cmap="viridis", opacity=0.8, show_scalar_bar=False)
+        plotter.add_mesh(wake_slice, scalars="U_q", clim=[0, 255], cmap="viridis", opacity=0.8, show_scalar_bar=False)
         field_name = "Velocity"
     
-    try:
-        seed_points = [[center[0]-3, y, z] for y in [-1.0, 0.0, 1.0] for z in [1.5, 2.0, 2.5]]
-        seed_poly = pv.PolyData(seed_points)
-        streamlines = volume_mesh.streamlines_from_source(seed_poly, vectors="U", max_steps=100, integration_direction='forward')
+    if streamlines is not None:
         plotter.add_mesh(streamlines, scalars="U", cmap="rainbow", line_width=2, opacity=0.9, show_scalar_bar=False)
-    except:
-        pass
     
-    plotter.add_mesh(bike_surface, color="darkblue", opacity=0.6, show_edges=True, edge_color="navy", line_width=0.3)
+    plotter.add_mesh(bike_surface, color="darkblue", opacity=0.6)
+    plotter.add_mesh(bike_edges, color="navy", line_width=0.3)
     plotter.add_scalar_bar(title=field_name, position_x=0.85, width=0.05, height=0.3, title_font_size=8, label_font_size=7)
     
     plotter.set_background("lightgray")
+
+def update_flow_analysis_camera(plotter, angle):
+    """Move the flow analysis camera to the current angle"""
     plotter.view_isometric()
     plotter.camera.azimuth = angle * 0.3
     plotter.camera.elevation = 15
     plotter.camera.zoom(1.0)
 
+def init_view_worker(view_index, bike_surface, bike_background, bike_edges, slices, streamlines, has_omega, has_k):
+    """Build one view in its own off-screen plotter, reused for every frame"""
+    plotter = pv.Plotter(off_screen=True, window_size=VIEW_SIZE)
+    if view_index == 0:
+        build_velocity_view(plotter, slices, bike_background, bike_edges)
+        update_camera = update_velocity_camera
+    elif view_index == 1:
+        build_pressure_view(plotter, slices, bike_background, bike_edges)
+        update_camera = update_pressure_camera
+    elif view_index == 2:
+        build_mesh_view(plotter, bike_surface)
+        update_camera = update_mesh_camera
+    else:
+        build_flow_analysis(plotter, slices, streamlines, bike_background, bike_edges, has_omega, has_k)
+        update_camera = update_flow_analysis_camera
+    
+    worker_state["plotter"] = plotter
+    worker_state["update_camera"] = update_camera
+
+def render_view(angle):
+    """Render this worker's view at the given angle as an RGB image"""
+    plotter = worker_state["plotter"]
+    worker_state["update_camera"](plotter, angle)
+    return plotter.screenshot(return_img=True, transparent_background=False)
+
+def has_nvenc():
+    """Check whether ffmpeg can open an NVENC H.264 encoder on this machine"""
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+           "-f", "lavfi", "-i", "nullsrc=s=256x256", "-frames:v", "1",
+           "-c:v", "h264_nvenc", "-f", "null", "-"]
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    except OSError:
+        return False
+
+def open_video_writer(output_file, size, fps):
+    """Start an ffmpeg process reading raw RGB frames on stdin, using NVENC when available and libx264 otherwise"""
+    if has_nvenc():
+        codec_args = ["-c:v", "h264_nvenc", "-preset", "p1", "-b:v", "20M"]
+    else:
+        codec_args = ["-c:v", "libx264", "-preset", "ultrafast", "-crf", "5"]
+    
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-hide_banner", "-loglevel", "error",
+           "-f", "rawvideo", "-vcodec", "rawvideo", "-s", f"{size[0]}x{size[1]}",
+           "-pix_fmt", "rgb24", "-r", str(fps), "-i", "-",
+           *codec_args, "-pix_fmt", "yuv420p", output_file]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
 def create_animation():
     """Create the CFD animation"""
     output_file = "motorbike_cfd_analysis.mp4"
     fps, duration = 20, 10
     total_frames = fps * duration
     
-    volume_mesh, bike_surface = load_data()
-    plotter = pv.Plotter(shape=(2, 2), off_screen=True, window_size=(1920, 1080))
+    bike_surface, bike_background, bike_edges, slices, streamlines, has_omega, has_k = load_data()
     angles = np.linspace(0, 360, total_frames, endpoint=False)
     
-    plotter.open_movie(output_file, framerate=fps, quality=9)
+    # One single-process pool per view so each worker keeps its own plotter across frames.
+    # Workers are spawned rather than forked so they never inherit the encoder's threads or pipe.
+    pools = [
+        ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn"), initializer=init_view_worker,
+                            initargs=(view_index, bike_surface, bike_background, bike_edges,
+                                      slices, streamlines, has_omega, has_k))
+        for view_index in range(4)
+    ]
+    frame_size = (VIEW_SIZE[0] * 2, VIEW_SIZE[1] * 2)
+    writer = open_video_writer(output_file, frame_size, fps)
     
-    for i, angle in enumerate(angles):
-        for row in range(2):
-            for col in range(2):
-                plotter.subplot(row, col)
-                plotter.clear()
-        
-        setup_velocity_view(plotter, volume_mesh, bike_surface, angle)
-        setup_pressure_view(plotter, volume_mesh, bike_surface, angle)
-        setup_mesh_view(plotter, bike_surface, angle)
-        setup_flow_analysis(plotter, volume_mesh, bike_surface, angle)
-        
-        plotter.write_frame()
+    # Two preallocated frames: one is filled while the encoder thread writes the other
+    frame_bufs = [np.empty((frame_size[1], frame_size[0], 3), dtype=np.uint8) for _ in range(2)]
+    pending = [None, None]
+    encoder = ThreadPoolExecutor(max_workers=1)
+    
+    try:
+        for i, angle in enumerate(angles):
+            futures = [pool.submit(render_view, angle) for pool in pools]
+            
+            slot = i % 2
+            if pending[slot] is not None:
+                pending[slot].result()
+            frame = frame_bufs[slot]
+            for view_index, future in enumerate(futures):
+                row, col = divmod(view_index, 2)
+                np.copyto(frame[row * VIEW_SIZE[1]:(row + 1) * VIEW_SIZE[1],
+                                col * VIEW_SIZE[0]:(col + 1) * VIEW_SIZE[0]], future.result())
+            pending[slot] = encoder.submit(writer.stdin.write, frame)
+            
+            if (i + 1) % (total_frames // 10) == 0:
+                print(f"Progress: {((i + 1) / total_frames) * 100:.0f}%")
         
-        if (i + 1) % (total_frames // 10) == 0:
-            print(f"Progress: {((i + 1) / total_frames) * 100:.0f}%")
+        for future in pending:
+            if future is not None:
+                future.result()
+    finally:
+        encoder.shutdown()
+        # A dead ffmpeg makes the final flush fail; still reap it and the render pools
+        with contextlib.suppress(BrokenPipeError):
+            writer.stdin.close()
+        returncode = writer.wait()
+        for pool in pools:
+            pool.shutdown()
     
-    plotter.close()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {returncode}")
     
     file_size = os.path.getsize(output_file) / (1024 * 1024)
     print(f"\n✅ Animation saved: {output_file}")
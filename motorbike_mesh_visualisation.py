@@ -4,22 +4,14 @@ Streamlined motorbike mesh visualization for OpenFOAM results.
 Provides simple, detailed, and exploded view options.
 """
 
-import os
 import pyvista as pv
 import numpy as np
 
+from motorbike_parts import load_parts
+
 def load_motorbike_parts():
-    """Load all motorbike mesh parts from VTK files"""
-    bike_parts = []
-    for root, dirs, files in os.walk("motorBike-VTK"):
-        for fname in files:
-            if fname.endswith("_500.vtk") and fname != "motorBike_500.vtk":
-                part_path = os.path.join(root, fname)
-                try:
-                    bike_parts.append(pv.read(part_path))
-                except:
-                    continue
-    return bike_parts
+    """Load all motorbike mesh parts from VTK files, from the cache if it is up to date"""
+    return load_parts()
 
 def simple_view():
     """Simple visualization with uniform coloring"""
@@ -79,21 +71,20 @@ def exploded_view():
     """Exploded view showing parts separated"""
     bike_parts = load_motorbike_parts()
     
-    all_centers = [part.center for part in bike_parts]
-    global_center = np.mean(all_centers, axis=0)
+    centers = np.asarray([part.center for part in bike_parts])
+    global_center = centers.mean(axis=0)
     explosion_factor = 0.3
     colors = ['red', 'blue', 'green', 'orange', 'purple', 'brown', 'pink', 'gray']
     
+    offsets = centers - global_center
+    norms = np.linalg.norm(offsets, axis=1, keepdims=True)
+    directions = np.divide(offsets, norms, out=np.zeros_like(offsets), where=norms > 0)
+    translations = directions * explosion_factor
+    
     plotter = pv.Plotter(title="Motorbike Mesh - Exploded View")
     
-    for i, part in enumerate(bike_parts):
-        offset_direction = np.array(part.center) - global_center
-        if np.linalg.norm(offset_direction) > 0:
-            offset_direction = offset_direction / np.linalg.norm(offset_direction)
-        else:
-            offset_direction = np.array([0, 0, 0])
-        
-        exploded_part = part.translate(offset_direction * explosion_factor)
+    for i, (part, translation) in enumerate(zip(bike_parts, translations)):
+        exploded_part = part.translate(translation, inplace=False)
         color = colors[i % len(colors)]
         plotter.add_mesh(exploded_part, color=color, opacity=0.8, show_edges=True, 
                         edge_color="black", line_width=0.2)
@@ -0,0 +1,75 @@
+"""
+Shared loader for the motorbike part meshes in motorBike-VTK.
+Used by both the CFD animation and the mesh visualisation scripts.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import pyvista as pv
+
+PARTS_DIR = "motorBike-VTK"
+CACHE_DIR = "cache"
+# Bump whenever the way cached parts are built changes, so older caches are rebuilt
+CACHE_VERSION = 2
+# Decimation applied to the surface behind the field panels; views that draw mesh edges use the raw parts
+PART_REDUCTION = 0.5
+
+logger = logging.getLogger(__name__)
+
+def iter_part_paths(base=PARTS_DIR):
+    """Yield the final-timestep part files under base, skipping the volume mesh"""
+    with os.scandir(base) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_part_paths(entry.path)
+            elif entry.name.endswith("_500.vtk") and entry.name != "motorBike_500.vtk":
+                yield entry.path
+
+def read_part(part_path, reduction):
+    """Read a single part file and simplify it if reduction > 0, returns None if it cannot be read"""
+    try:
+        part = pv.read(part_path)
+    except (OSError, RuntimeError, ValueError) as e:
+        logger.warning("skip %s: %s", part_path, e)
+        return None
+    return simplify_part(part, reduction) if reduction > 0 else part
+
+def simplify_part(part, reduction):
+    """Triangulate a part and decimate it by reduction, keeping its topology and outline"""
+    if not isinstance(part, pv.PolyData):
+        part = part.extract_surface()
+    return part.triangulate().decimate_pro(reduction, preserve_topology=True, boundary_vertex_deletion=False)
+
+def cache_key(part_paths, reduction):
+    """Describe the source files and build settings a cached part set was made from"""
+    newest = max((os.stat(path).st_mtime_ns for path in part_paths), default=0)
+    return f"version={CACHE_VERSION} reduction={reduction} parts={len(part_paths)} newest_mtime={newest}"
+
+def load_parts(reduction=0.0):
+    """Read all part files in parallel, from the cache if it matches the current source files"""
+    part_paths = list(iter_part_paths())
+    key = cache_key(part_paths, reduction)
+    cache_file = os.path.join(CACHE_DIR, f"bike_parts_r{reduction}.vtm")
+    key_file = cache_file + ".key"
+    
+    if os.path.exists(cache_file) and os.path.exists(key_file):
+        with open(key_file) as f:
+            if f.read() == key:
+                return list(pv.read(cache_file))
+    
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        bike_parts = [part for part in executor.map(partial(read_part, reduction=reduction), part_paths)
+                      if part is not None]
+    
+    if not bike_parts:
+        logger.warning("no parts loaded from %s, not caching", PARTS_DIR)
+        return bike_parts
+    
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    pv.MultiBlock(bike_parts).save(cache_file, binary=True)
+    # Written last so an interrupted save is never mistaken for a valid cache
+    with open(key_file, "w") as f:
+        f.write(key)
+    return bike_parts